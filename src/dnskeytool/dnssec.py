@@ -1,14 +1,62 @@
+import bisect
+import fnmatch
+import functools
+import grp
+import os
+import pwd
+import re
 import shutil
 import subprocess
 import sys
-import textwrap
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Callable, List, Tuple
 
+import dns.dnssec
+import dns.exception
+import dns.name
 import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
 
-from .dtutil import parse_dnsdatetime, fmt_dnsdatetime, nowutc
+from .dtutil import parse_dnstimestamp, fmt_dnsdatetime, nowutc
+
+# Kzone.+aaa+iiiii
+_NAME_RE = re.compile(r"K(.+)\+(\d+)\+(\d+)$")
+# comment lines written by dnssec-keygen/dnssec-settime that carry key metadata, and the DNSKEY record itself
+_HDR_RE = re.compile(r"^;\s*(?:(Created|Publish|Activate|Inactive|Delete):\s*(\d+)"
+                     r"|This is a (\S+) key, keyid (\d+), for (\S+))"
+                     r"|^[^;\n].*?DNSKEY(.*)$", re.M)
+_HDR_FIELDS = {
+    "Created": "d_create",
+    "Publish": "d_publish",
+    "Activate": "d_active",
+    "Inactive": "d_inactive",
+    "Delete": "d_delete",
+}
+
+# key states in order of progression, see KeyFile.state()
+_STATES = ("PUB", "ACT", "INAC", "DEL")
+
+_IN = dns.rdataclass.IN
+_DNSKEY = dns.rdatatype.DNSKEY
+_SHA256 = dns.dnssec.DSDigest.SHA256
+
+
+@functools.lru_cache(maxsize=1024)
+def _abs_zone(zone: str) -> dns.name.Name:
+    return dns.name.from_text(zone)
+
+
+@functools.lru_cache(maxsize=None)
+def _user_name(uid: int) -> str:
+    return pwd.getpwuid(uid).pw_name
+
+
+@functools.lru_cache(maxsize=None)
+def _group_name(gid: int) -> str:
+    return grp.getgrgid(gid).gr_name
 
 
 class KeyFile:
@@ -17,42 +65,65 @@ class KeyFile:
         self.path_rr = path
         self.path_pk = path.with_suffix(".private")
         self.name = path.stem
-        ff = path.stem.split("+")
-        self.zone = ff[0][1:]
-        self.algo = int(ff[1])
-        self.keyid = int(ff[2])
-        self.type = ""
-        self.d_create = None
-        self.d_publish = None
-        self.d_active = None
-        self.d_inactive = None
-        self.d_delete = None
-        with path.open("rt") as key:
-            for line in key.readlines():
-                if not line.startswith(";"):
-                    continue
-                if "Created:" in line:
-                    self.d_create = parse_dnsdatetime(line)
-                elif "Publish:" in line:
-                    self.d_publish = parse_dnsdatetime(line)
-                elif "Activate:" in line:
-                    self.d_active = parse_dnsdatetime(line)
-                elif "Inactive:" in line:
-                    self.d_inactive = parse_dnsdatetime(line)
-                elif "Delete:" in line:
-                    self.d_delete = parse_dnsdatetime(line)
-                elif "This is a " in line and "keyid" in line and "for" in line:
-                    words = line.split()
-                    if words[4] == "zone-signing":
-                        self.type = "ZSK"
-                    elif words[4] == "key-signing":
-                        self.type = "KSK"
-                    else:
-                        raise ValueError(f"Unexpected key type word: '{words[4]}'")
-                    if self.keyid != int(words[7][:-1]):
-                        raise ValueError(f"{self.name} claims to be for id {self.keyid}, but is not!")
-                    if self.zone != words[-1]:
-                        raise ValueError(f"{self.name} claims to be for id {self.zone}, but is not!")
+        m = _NAME_RE.match(self.name)
+        if m is None:
+            raise ValueError(f"Unexpected key file name: '{path.name}'")
+        self.zone = m.group(1)
+        self.algo = int(m.group(2))
+        self.keyid = int(m.group(3))
+
+    @functools.cached_property
+    def _header(self) -> dict:
+        # only read the file once any of the header fields or the record is actually needed
+        hdr = dict(type="", d_create=None, d_publish=None, d_active=None, d_inactive=None, d_delete=None, rr=[])
+        for m in _HDR_RE.finditer(self.path_rr.read_text()):
+            field, stamp, kind, keyid, zone, rdata = m.groups()
+            if rdata is not None:
+                hdr["rr"].append(rdata.strip())
+                continue
+            if field is not None:
+                hdr[_HDR_FIELDS[field]] = parse_dnstimestamp(stamp)
+                continue
+            if kind == "zone-signing":
+                hdr["type"] = "ZSK"
+            elif kind == "key-signing":
+                hdr["type"] = "KSK"
+            else:
+                raise ValueError(f"Unexpected key type word: '{kind}'")
+            if self.keyid != int(keyid):
+                raise ValueError(f"{self.name} claims to be for id {self.keyid}, but is not!")
+            if self.zone != zone:
+                raise ValueError(f"{self.name} claims to be for id {self.zone}, but is not!")
+        return hdr
+
+    def load_header(self) -> "KeyFile":
+        # force reading the header now, so broken files are reported while listing
+        _ = self._header
+        return self
+
+    @property
+    def type(self) -> str:
+        return self._header["type"]
+
+    @property
+    def d_create(self) -> Optional[datetime]:
+        return self._header["d_create"]
+
+    @property
+    def d_publish(self) -> Optional[datetime]:
+        return self._header["d_publish"]
+
+    @property
+    def d_active(self) -> Optional[datetime]:
+        return self._header["d_active"]
+
+    @property
+    def d_inactive(self) -> Optional[datetime]:
+        return self._header["d_inactive"]
+
+    @property
+    def d_delete(self) -> Optional[datetime]:
+        return self._header["d_delete"]
 
     def __repr__(self):
         return f"KeyFile({str(self)})"
@@ -61,71 +132,111 @@ class KeyFile:
         return f"{self.zone}+{self.algo:03d}+{self.keyid:05d}"
 
     def sort_key(self):
-        return f"{self.zone}+{self.type}+{self.algo:03d}+{self.keyid:05d}"
+        return self.zone, self.type, self.algo, self.keyid
+
+    def signer_id(self) -> Tuple[int, int]:
+        return self.algo, self.keyid
 
-    def signer_id(self):
-        return f"{self.algo:03d}+{self.keyid:05d}"
+    @functools.cached_property
+    def _timeline(self) -> Tuple[List[datetime], List[str]]:
+        # sorted transition dates, each paired with the most advanced state reached by then
+        events = sorted((d, rank) for rank, d in enumerate([self.d_publish, self.d_active, self.d_inactive, self.d_delete])
+                        if d is not None)
+        dates = []
+        states = []
+        reached = 0
+        for d, rank in events:
+            reached = max(reached, rank)
+            dates.append(d)
+            states.append(_STATES[reached])
+        return dates, states
 
     def state(self, ref=None):
         if ref is None:
             ref = nowutc()
-        if self.d_delete is not None and self.d_delete <= ref:
-            return "DEL"
-        if self.d_inactive is not None and self.d_inactive <= ref:
-            return "INAC"
-        if self.d_active is not None and self.d_active <= ref:
-            return "ACT"
-        if self.d_publish is not None and self.d_publish <= ref:
-            return "PUB"
+        dates, states = self._timeline
+        i = bisect.bisect_right(dates, ref)
+        if i:
+            return states[i - 1]
         if self.d_create is not None and self.d_create > ref:
             return "FUT"
         return ""
 
+    def active_window(self) -> Optional[Tuple[datetime, Optional[datetime]]]:
+        # the span in which state() is "ACT", read off the same timeline
+        dates, states = self._timeline
+        if "ACT" not in states:
+            return None
+        first = states.index("ACT")
+        for d, state in zip(dates[first:], states[first:]):
+            if state != "ACT":
+                return dates[first], d
+        return dates[first], None
+
+    @functools.cached_property
+    def _change_dates(self) -> Optional[List[datetime]]:
+        # check if the ordering is consistent, but ignore Created
+        assigned = [d for d in [self.d_publish, self.d_active, self.d_inactive, self.d_delete] if d is not None]
+        if sorted(assigned) == assigned:
+            return assigned
+        return None
+
     def next_change(self, ref=None):
         if ref is None:
             ref = nowutc()
-        # check if the ordering is consistent, but ignore Created
-        assigned = list(filter(lambda x: x is not None,
-                               [self.d_publish, self.d_active, self.d_inactive, self.d_delete]))
-        expected_order = list(sorted(assigned))
-        if expected_order == assigned:
-            return next(filter(lambda x: x > ref, assigned), None)
-        raise ValueError("Inconsistent Dates")
+        dates = self._change_dates
+        if dates is None:
+            raise ValueError("Inconsistent Dates")
+        i = bisect.bisect_right(dates, ref)
+        return dates[i] if i < len(dates) else None
 
     @staticmethod
-    def _wrap_rr(text: str, initial_indent: str=""):
-        return textwrap.wrap(text, width=128, initial_indent=initial_indent, subsequent_indent=initial_indent + "    ", break_long_words=False)
+    def _wrap_rr(text: str, initial_indent: str = "", width: int = 128):
+        # RR data is just space-separated tokens, so a greedy fill is all that's needed here
+        lines = []
+        indent = initial_indent
+        words = []
+        used = len(indent)
+        for word in text.split():
+            if words and used + 1 + len(word) > width:
+                lines.append(indent + " ".join(words))
+                indent = initial_indent + "    "
+                words = []
+                used = len(indent)
+            used += len(word) + (1 if words else 0)
+            words.append(word)
+        if words:
+            lines.append(indent + " ".join(words))
+        return lines
 
     def dnskey_rr(self, *, indent=""):
         ret = []
-        with self.path_rr.open("rt") as key:
-            for line in key.readlines():
-                if not line.startswith(";") and "DNSKEY" in line:
-                    key = line.split("DNSKEY")[1].strip()
-                    key = self._wrap_rr(key, indent)
-                    ret.extend(key)
+        for key in self._header["rr"]:
+            ret.extend(self._wrap_rr(key, indent))
         return "\n".join(ret)
 
     def ds_rr(self, *, indent=""):
         # Try native first
         rr = self.dnskey_rr()
         try:
-            abs_zone = dns.name.from_text(self.zone)
-            dnskey = dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.DNSKEY, rr.replace("\n", " "))
-            ds = dns.dnssec.make_ds(abs_zone, dnskey, dns.dnssec.DSDigest.SHA256)
+            dnskey = dns.rdata.from_text(_IN, _DNSKEY, rr.replace("\n", " "))
+            ds = dns.dnssec.make_ds(_abs_zone(self.zone), dnskey, _SHA256)
             return "\n".join(self._wrap_rr("DS " + ds.to_text().upper(), indent))
         except dns.exception.DNSException:
             return ""
 
     def is_supported(self) -> Optional[bool]:
         from .data.supported_keys import SUPPORTED_ALG_TLD
-        labels = self.zone.split(".")
-        for last in reversed(range(1, len(labels))):
-            check = ".".join(labels[-last-1:-1])
+        # try the longest suffix first by stripping one label at a time
+        check = self.zone[:-1] if self.zone.endswith(".") else self.zone
+        while True:
             supp = SUPPORTED_ALG_TLD.get(check, None)
             if supp is not None:
                 return self.algo in supp
-        return None
+            dot = check.find(".")
+            if dot < 0:
+                return None
+            check = check[dot + 1:]
 
     def set_perms(self, *,
                   rr_perm: int = 0o644, rr_owner: str = "root", rr_grp: str = "bind",
@@ -134,11 +245,13 @@ class KeyFile:
 
         def adjust(file: Path, perm, user, grp):
             change_made = False
-            if file.owner() != user or file.group() != grp:
+            # one stat for owner, group and mode
+            st = file.stat()
+            if _user_name(st.st_uid) != user or _group_name(st.st_gid) != grp:
                 if not check_only:
                     shutil.chown(file, user=user, group=grp)
                 change_made = True
-            if file.stat().st_mode & 0o777 != perm:
+            if st.st_mode & 0o777 != perm:
                 if not check_only:
                     file.chmod(perm)
                 change_made = True
@@ -164,26 +277,41 @@ class DnsSec:
             raise OSError(f"Error executing process: {ret.returncode}\n{ret.stderr}")
         return ret.stdout.strip().splitlines(keepends=False)
 
+    @staticmethod
+    def _keyfile_matcher(zone: str) -> Callable[[str], bool]:
+        if any(c in zone for c in "*?["):
+            return re.compile(fnmatch.translate(f"K{zone}+*+*.key")).match
+        # plain zone name: fixed prefix, no need for a regex
+        prefix = f"K{zone}+"
+
+        def matcher(name: str) -> bool:
+            return name.startswith(prefix) and name.endswith(".key") and "+" in name[len(prefix):]
+        return matcher
+
     def _iter_keyfiles(self, zone: str):
-        files = self.path.glob(f"K{zone}+*+*.key")
-        for file in files:
-            if not file.with_suffix(".private").exists():
-                print(f"Warning: {file.name} exists, but corresponding .private does not!", file=sys.stderr)
+        matches = self._keyfile_matcher(zone)
+        # one directory listing answers both the pattern match and the .private check
+        with os.scandir(self.path) as it:
+            names = [entry.name for entry in it]
+        present = set(names)
+        for name in names:
+            if not matches(name):
+                continue
+            if name[:-len(".key")] + ".private" not in present:
+                print(f"Warning: {name} exists, but corresponding .private does not!", file=sys.stderr)
                 continue
-            yield file
+            yield self.path / name
 
     def list_keys(self, zone: str, recursive=False):
-        result = []
         if recursive:
             zone = "*." + zone.lstrip(".")
-        for pk in self._iter_keyfiles(zone):
-            kf = KeyFile(pk)
-            result.append(kf)
-        return list(sorted(result, key=KeyFile.sort_key))
+        result = [KeyFile(pk).load_header() for pk in self._iter_keyfiles(zone)]
+        return sorted(result, key=KeyFile.sort_key)
 
-    def key_settime(self, key: KeyFile, *,
-                    publish: Optional[datetime] = None, activate: Optional[datetime] = None,
-                    inactivate: Optional[datetime] = None, delete: Optional[datetime] = None):
+    @staticmethod
+    def _settime_args(key: KeyFile, *,
+                      publish: Optional[datetime] = None, activate: Optional[datetime] = None,
+                      inactivate: Optional[datetime] = None, delete: Optional[datetime] = None) -> List[str]:
         p = []
         if publish is not None:
             p += ["-P", fmt_dnsdatetime(publish)]
@@ -194,7 +322,37 @@ class DnsSec:
         if delete is not None:
             p += ["-D", fmt_dnsdatetime(delete)]
         if p:
-            self._call(["dnssec-settime", *p, key.name])
+            return ["dnssec-settime", *p, key.name]
+        return []
+
+    def key_settime(self, key: KeyFile, *,
+                    publish: Optional[datetime] = None, activate: Optional[datetime] = None,
+                    inactivate: Optional[datetime] = None, delete: Optional[datetime] = None):
+        args = self._settime_args(key, publish=publish, activate=activate, inactivate=inactivate, delete=delete)
+        if args:
+            self._call(args)
+
+    def key_settime_many(self, changes: List[Tuple[KeyFile, dict]]):
+        # each call only touches its own key file, so the process startup cost can overlap
+        calls = [args for args in (self._settime_args(key, **times) for key, times in changes) if args]
+        if not calls:
+            return
+        errors = []
+        with ThreadPoolExecutor(max_workers=min(8, len(calls))) as ex:
+            running = [ex.submit(self._call, args) for args in calls]
+            for done in as_completed(running):
+                if done.cancelled():
+                    continue
+                try:
+                    done.result()
+                except OSError as e:
+                    if not errors:
+                        # stop at the first failure, calls already started still finish
+                        for fut in running:
+                            fut.cancel()
+                    errors.append(str(e))
+        if errors:
+            raise OSError("\n".join(errors))
 
     def key_gentemplate(self, template: KeyFile,
                         publish: Optional[datetime] = None, activate: Optional[datetime] = None,
@@ -1,3 +1,5 @@
+import functools
+import re
 from datetime import datetime, timezone, timedelta
 from typing import Optional
 
@@ -8,12 +10,18 @@ def nowutc():
 
 def parse_dnsdatetime(colon_line: str) -> datetime:
     words = colon_line.split()
-    dt = words[2]
-    if len(dt) != len("yyyymmddhhmmss"):
-        raise ValueError(f"Unexpected date format: '{colon_line}'")
-    d = datetime.strptime(dt, "%Y%m%d%H%M%S")
+    return parse_dnstimestamp(words[2])
+
+
+# key files of one zone tend to share timestamps (keys are created/rotated in batches)
+@functools.lru_cache(maxsize=4096)
+def parse_dnstimestamp(dt: str) -> datetime:
+    if len(dt) != len("yyyymmddhhmmss") or not (dt.isascii() and dt.isdigit()):
+        raise ValueError(f"Unexpected date format: '{dt}'")
+    # fixed-width fields, no need for the strptime machinery
     # date strings in files are always UTC
-    return d.replace(tzinfo=timezone.utc)
+    return datetime(int(dt[0:4]), int(dt[4:6]), int(dt[6:8]), int(dt[8:10]), int(dt[10:12]), int(dt[12:14]),
+                    tzinfo=timezone.utc)
 
 
 def fmt_dnsdatetime(date: datetime) -> str:
@@ -30,44 +38,51 @@ MONTHSEC = DAYSEC * 30
 YEARSEC = DAYSEC * 365
 
 
+_RELATIVE_RE = re.compile(r"([+-]?\d+)(mi|[hdwmy])?")
+_RELATIVE_UNITS = {
+    None: 1,
+    "mi": MINSEC,
+    "h": HOURSEC,
+    "d": DAYSEC,
+    "w": WEEKSEC,
+    "m": MONTHSEC,
+    "y": YEARSEC,
+}
+
+
+# argparse defaults and user input only ever use a handful of distinct intervals
+@functools.lru_cache(maxsize=128)
 def parse_datetime_relative(inp: str) -> timedelta:
-    # number of seconds
-    try:
-        ts = int(inp)
-        return timedelta(seconds=ts)
-    except ValueError:
-        pass
-    try:
-        if inp.endswith("mi"):
-            return timedelta(minutes=int(inp[:-2]))
-        if inp.endswith("h"):
-            return timedelta(hours=int(inp[:-1]))
-        if inp.endswith("d"):
-            return timedelta(days=int(inp[:-1]))
-        if inp.endswith("w"):
-            return timedelta(weeks=int(inp[:-1]))
-        if inp.endswith("m"):
-            return timedelta(days=int(inp[:-1]) * 30)
-        if inp.endswith("y"):
-            return timedelta(days=int(inp[:-1]) * 365)
-    except ValueError:
-        pass
-    raise ValueError(f"{inp} is not a valid relative date/time value")
+    # number of seconds, optionally followed by a unit
+    m = _RELATIVE_RE.fullmatch(inp)
+    if m is None:
+        raise ValueError(f"{inp} is not a valid relative date/time value")
+    return timedelta(seconds=int(m.group(1)) * _RELATIVE_UNITS[m.group(2)])
 
 
 def parse_datetime(inp: str) -> datetime:
+    # time relative to now, must be computed every time
+    if inp.startswith("+"):
+        return nowutc() + parse_datetime_relative(inp[1:])
+    return _parse_datetime_absolute(inp)
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_datetime_absolute(inp: str) -> datetime:
+    # check the shape of the input first instead of letting each parser fail in turn
+    numeric = inp.isascii() and inp.removeprefix("-").isdigit()
     # DNS timestamp format YYYYMMDDHHmmss
-    if len(inp) == 14 and inp.startswith("20"):
+    if numeric and len(inp) == 14 and inp.startswith("20"):
         try:
-            return parse_dnsdatetime(inp)
+            return parse_dnstimestamp(inp)
         except ValueError:
             pass
     # unix timestamp (seconds)
-    try:
-        ts = int(inp)
-        return datetime.fromtimestamp(ts, tz=timezone.utc)
-    except ValueError:
-        pass
+    if numeric:
+        try:
+            return datetime.fromtimestamp(int(inp), tz=timezone.utc)
+        except ValueError:
+            pass
     # ISO format
     try:
         d = datetime.fromisoformat(inp)
@@ -76,30 +91,28 @@ def parse_datetime(inp: str) -> datetime:
         return d
     except ValueError:
         pass
-    # time relative to now
-    if inp.startswith("+"):
-        return nowutc() + parse_datetime_relative(inp[1:])
     raise ValueError(f"{inp} is not a valid date/time value")
 
 
+# a unit is only used once it's at least 1.2 of itself, so 8 days are not shortened to 1w
+_TIMESPAN_UNITS = tuple((unit, unit * 1.2, name) for unit, name in (
+    (YEARSEC, "y"),
+    (WEEKSEC, "w"),
+    (DAYSEC, "d"),
+    (HOURSEC, "h"),
+    (MINSEC, "m"),
+))
+
+
 def fmt_timespan(span: timedelta, compressed=True) -> str:
     sec = int(span.total_seconds())
     s = []
-    if sec >= YEARSEC * 1.2:
-        s.append(f"{sec // YEARSEC}y")
-        sec = sec % YEARSEC
-    if sec >= WEEKSEC * 1.2:
-        s.append(f"{sec // WEEKSEC}w")
-        sec = sec % WEEKSEC
-    if sec >= DAYSEC * 1.2:
-        s.append(f"{sec // DAYSEC}d")
-        sec = sec % DAYSEC
-    if sec >= HOURSEC * 1.2:
-        s.append(f"{sec // HOURSEC}h")
-        sec = sec % HOURSEC
-    if sec >= MINSEC * 1.2:
-        s.append(f"{sec // MINSEC}m")
-        sec = sec % MINSEC
+    for unit, threshold, name in _TIMESPAN_UNITS:
+        if sec >= threshold:
+            count, sec = divmod(sec, unit)
+            if compressed:
+                return f"{count}{name}"
+            s.append(f"{count}{name}")
     if sec >= 0:
         s.append(f"{sec}s")
     if compressed:
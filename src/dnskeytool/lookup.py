@@ -1,4 +1,6 @@
-from typing import List, Dict, Optional, Union
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Union, Tuple
 
 import dns.dnssec
 import dns.exception
@@ -11,7 +13,9 @@ import dns.resolver
 
 from .resolver import BaseResolver, StubResolver
 
-ListOrError = Union[dns.exception.DNSException, List[str]]
+# (algorithm, key tag), compare with KeyFile.signer_id()
+KeyId = Tuple[int, int]
+ListOrError = Union[dns.exception.DNSException, List[KeyId]]
 
 
 class PublishedKeyCollection:
@@ -22,6 +26,7 @@ class PublishedKeyCollection:
         self.zone_ds: Dict[str, Dict[str, ListOrError]] = dict()
         self.zone_dnskey: Dict[str, Dict[str, ListOrError]] = dict()
         self.zone_signers: Dict[str, Dict[str, ListOrError]] = dict()
+        self._contacted: Optional[List[str]] = None
 
     def set_explicit_nameservers(self, servers: List[str]):
         self.explicit_nameservers = servers
@@ -41,50 +46,66 @@ class PublishedKeyCollection:
         self.zone_dnskey.setdefault(zone, dict())
         self.zone_signers.setdefault(zone, dict())
 
-        # If the user requested multiple resolvers, query each individually
-        expl_roots = self.resolver.explicit_resolvers()
-        if expl_roots is not None:
-            for pubres in expl_roots:
-                try:
-                    answer = self.resolver.query_at(zone, "DS", pubres)
-                    self.zone_ds[zone][answer.nameserver] = sorted(set(self._store_ds(ds) for ds in answer))
-                except dns.resolver.NoAnswer as na:
-                    # no DS keys published
-                    self.zone_ds[zone][pubres] = []
-                except dns.exception.DNSException as e:
-                    self.zone_ds[zone][pubres] = e
-        else:
-            # Otherwise, let resolver handle it
+        # all queries are independent and only wait on the network, so run them side by side
+        with ThreadPoolExecutor(max_workers=16) as ex:
+            # If the user requested multiple resolvers, query each individually
+            expl_roots = self.resolver.explicit_resolvers()
+            if expl_roots is not None:
+                ds_results = [ex.submit(self._query_ds, zone, pubres) for pubres in expl_roots]
+            else:
+                # Otherwise, let resolver handle it
+                ds_results = [ex.submit(self._query_ds, zone, None)]
+
             try:
-                answer = self.resolver.query(zone, "DS")
-                self.zone_ds[zone][answer.nameserver] = sorted(set(self._store_ds(ds) for ds in answer))
-            except dns.resolver.NoAnswer as na:
-                # no DS keys published
-                self.zone_ds[zone][na.nameserver] = []
+                query_servers = self._get_ns_list(zone)
             except dns.exception.DNSException as e:
-                self.zone_ds[zone]["ERR"] = e
+                query_servers = []
+            dnskey_results = [ex.submit(self._query_dnskeys, zone, ns) for ns in query_servers]
+            signer_results = [ex.submit(self._query_signers, zone, ns) for ns in query_servers]
+
+            for result in ds_results:
+                ns, ds = result.result()
+                self.zone_ds[zone][ns] = ds
+            for ns, dnskeys, signers in zip(query_servers, dnskey_results, signer_results):
+                self.zone_dnskey[zone][ns] = dnskeys.result()
+                self.zone_signers[zone][ns] = signers.result()
+        self.known_zones.add(zone)
+        self._contacted = None
 
+    def _query_ds(self, zone: str, pubres: Optional[str]) -> Tuple[str, ListOrError]:
         try:
-            query_servers = self._get_ns_list(zone)
+            if pubres is not None:
+                answer = self.resolver.query_at(zone, "DS", pubres)
+            else:
+                answer = self.resolver.query(zone, "DS")
+            return answer.nameserver, sorted({self._store_ds(ds) for ds in answer})
+        except dns.resolver.NoAnswer as na:
+            # no DS keys published
+            return pubres if pubres is not None else na.nameserver, []
         except dns.exception.DNSException as e:
-            query_servers = []
-        for ns in query_servers:
-            nsip = self.resolver.resolve_host(ns)
-            try:
-                answer = self.resolver.query_at(zone, "DNSKEY", nsip)
-                self.zone_dnskey[zone][ns] = sorted(set(self._store_dnskey(dnskey) for dnskey in answer))
-            except dns.resolver.NoAnswer as na:
-                self.zone_dnskey[zone][ns] = []
-            except dns.exception.DNSException as e:
-                self.zone_dnskey[zone][ns] = e
-            try:
-                answer = self.resolver.query_at(zone, "RRSIG", nsip)
-                self.zone_signers[zone][ns] = sorted(set(self._store_rrsig(sig) for sig in answer))
-            except dns.resolver.NoAnswer as na:
-                self.zone_dnskey[zone][ns] = []
-            except dns.exception.DNSException as e:
-                self.zone_signers[zone][ns] = e
-        self.known_zones.add(zone)
+            return pubres if pubres is not None else "ERR", e
+
+    def _query_dnskeys(self, zone: str, ns: str) -> ListOrError:
+        nsip = self.resolver.resolve_host(ns)
+        try:
+            answer = self.resolver.query_at(zone, "DNSKEY", nsip)
+            # an rrset holds distinct keys, so their ids are already unique
+            return sorted(self._store_dnskey(dnskey) for dnskey in answer)
+        except dns.resolver.NoAnswer:
+            return []
+        except dns.exception.DNSException as e:
+            return e
+
+    def _query_signers(self, zone: str, ns: str) -> ListOrError:
+        nsip = self.resolver.resolve_host(ns)
+        try:
+            answer = self.resolver.query_at(zone, "RRSIG", nsip)
+            # one signature per covered type, so the same signer shows up repeatedly
+            return sorted({self._store_rrsig(sig) for sig in answer})
+        except dns.resolver.NoAnswer:
+            return []
+        except dns.exception.DNSException as e:
+            return e
 
     def _get_ns_list(self, zone: str):
         # user-defined server list
@@ -95,26 +116,30 @@ class PublishedKeyCollection:
         return [rr.target.canonicalize().to_text() for rr in answer]
 
     @staticmethod
-    def _store_ds(ds: dns.rdtypes.ANY.DS.DS):
-        return f"{ds.algorithm:03d}+{ds.key_tag:05d}"
+    def _store_ds(ds: dns.rdtypes.ANY.DS.DS) -> KeyId:
+        return ds.algorithm, ds.key_tag
 
     @staticmethod
-    def _store_dnskey(dnskey: dns.rdtypes.ANY.DNSKEY.DNSKEY):
-        key_tag = dns.dnssec.key_id(dnskey)
-        return f"{dnskey.algorithm:03d}+{key_tag:05d}"
+    def _store_dnskey(dnskey: dns.rdtypes.ANY.DNSKEY.DNSKEY) -> KeyId:
+        return dnskey.algorithm, dns.dnssec.key_id(dnskey)
 
     @staticmethod
-    def _store_rrsig(sig: dns.rdtypes.ANY.RRSIG.RRSIG):
-        return f"{sig.algorithm:03d}+{sig.key_tag:05d}"
+    def _store_rrsig(sig: dns.rdtypes.ANY.RRSIG.RRSIG) -> KeyId:
+        return sig.algorithm, sig.key_tag
 
     def contacted_servers(self):
-        dsns = sorted(set(ns for zn in self.zone_ds.values() for ns in zn.keys()))
-        zonens = sorted(set(ns for zn in self.zone_dnskey.values() for ns in zn.keys()))
-        return list(dsns) + list(zonens)
+        # only changes when another zone is queried, but is asked for every table row
+        if self._contacted is None:
+            dsns = sorted({ns for zn in self.zone_ds.values() for ns in zn})
+            zonens = sorted({ns for zn in self.zone_dnskey.values() for ns in zn})
+            self._contacted = dsns + zonens
+        return list(self._contacted)
 
 
+@functools.lru_cache(maxsize=1024)
 def shorten_dns(name: str) -> str:
-    if dns.inet.is_address(name):
+    # only something with a colon or a trailing digit can be an address, skip the parse attempts otherwise
+    if (":" in name or name[-1:].isdigit()) and dns.inet.is_address(name):
         return name
     try:
         nam = dns.name.from_text(name).canonicalize()
@@ -1,8 +1,30 @@
-from typing import Optional, List, Iterable, Iterator
+import base64
+import contextlib
+import copy
+import dbm
+import itertools
+import json
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, wait, as_completed, FIRST_COMPLETED
+from typing import Optional, List, Iterable, Iterator, Dict, Tuple
 
 import dns
 from dns.resolver import Answer
 
+from .data.dns import ROOT_SERVERS
+
+# seconds to wait for a single nameserver before moving on to the next
+QUERY_TIMEOUT = 5.0
+_ROOTS_V4_FIRST = tuple(v4 for h, v4, v6 in ROOT_SERVERS) + tuple(v6 for h, v4, v6 in ROOT_SERVERS)
+_ROOTS_V6_FIRST = tuple(v6 for h, v4, v6 in ROOT_SERVERS) + tuple(v4 for h, v4, v6 in ROOT_SERVERS)
+
+# nameservers asked at the same time during recursion, so one slow server does not stall the walk
+RACE_WIDTH = 3
+# threads shared by all queries of a resolver
+QUERY_WORKERS = 16
+
 
 def find_rrsets(query: dns.rrset.RRset, section: List[dns.rrset.RRset]) -> List[dns.rrset.RRset]:
     matching = []
@@ -12,11 +34,54 @@ def find_rrsets(query: dns.rrset.RRset, section: List[dns.rrset.RRset]) -> List[
     return matching
 
 
+class _Task:
+    # work for the shared pool that can also be run by whoever needs its result first, so threads
+    # waiting on nested lookups can't starve the pool
+    def __init__(self, fn, *args) -> None:
+        self.fn = fn
+        self.args = args
+        self.future = Future()
+        self._lock = threading.Lock()
+        self._claimed = False
+
+    def _claim(self) -> bool:
+        with self._lock:
+            if self._claimed:
+                return False
+            self._claimed = True
+            return True
+
+    @property
+    def started(self) -> bool:
+        return self._claimed
+
+    def run(self) -> None:
+        if not self._claim():
+            return
+        self.future.set_running_or_notify_cancel()
+        try:
+            self.future.set_result(self.fn(*self.args))
+        except BaseException as ex:
+            self.future.set_exception(ex)
+
+    def cancel(self) -> None:
+        if self._claim():
+            self.future.cancel()
+
+    def result(self):
+        self.run()
+        return self.future.result()
+
+
 class BaseResolver:
 
     def __init__(self) -> None:
         super().__init__()
         self.prefer_v4 = False
+        self._host_cache: Dict[str, str] = dict()
+        # lookups currently running, so concurrent callers for the same host wait for them
+        self._host_pending: Dict[str, Future] = dict()
+        self._host_lock = threading.Lock()
 
     def _af_order(self):
         if self.prefer_v4:
@@ -33,9 +98,42 @@ class BaseResolver:
     def query_at(self, zone: str, what: str, where: str) -> Answer:
         pass
 
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "BaseResolver":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
     def resolve_host(self, hostname: str) -> str:
         if dns.inet.is_address(hostname):
             return hostname
+        # nameserver hosts are shared between many zones, only look each up once
+        with self._host_lock:
+            address = self._host_cache.get(hostname)
+            if address is not None:
+                return address
+            pending = self._host_pending.get(hostname)
+            owner = pending is None
+            if owner:
+                pending = self._host_pending[hostname] = Future()
+        if not owner:
+            return pending.result()
+        try:
+            address = self._lookup_host(hostname)
+            self._host_cache[hostname] = address
+            pending.set_result(address)
+            return address
+        except BaseException as ex:
+            pending.set_exception(ex)
+            raise
+        finally:
+            with self._host_lock:
+                del self._host_pending[hostname]
+
+    def _lookup_host(self, hostname: str) -> str:
         for af in self._af_order():
             try:
                 answer = self.query(hostname, af)
@@ -53,6 +151,17 @@ class StubResolver(BaseResolver):
     def __init__(self, query_servers: List[str]) -> None:
         super().__init__()
         self.servers = query_servers
+        # constructing a Resolver reads the system configuration, so only do that once and derive
+        # the per-server resolvers from it
+        self._resolver = dns.resolver.Resolver()
+        if query_servers:
+            self._resolver.nameservers = list(query_servers)
+        self._resolvers = {tuple(query_servers or ()): self._resolver}
+        self._resolvers_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=QUERY_WORKERS)
+
+    def close(self) -> None:
+        self._pool.shutdown(cancel_futures=True)
 
     def explicit_resolvers(self) -> Optional[List[str]]:
         return self.servers
@@ -75,39 +184,129 @@ class StubResolver(BaseResolver):
             na.nameserver = res.nameservers[-1]
             raise na
 
+    def _resolver_for(self, where: str) -> dns.resolver.Resolver:
+        # zones are verified from several threads
+        with self._resolvers_lock:
+            resolver = self._resolvers.get((where,))
+            if resolver is None:
+                resolver = copy.copy(self._resolver)
+                resolver.nameservers = [where]
+                self._resolvers[(where,)] = resolver
+        return resolver
+
     def query_at(self, zone: str, what: str, where: str) -> Answer:
-        resolver = dns.resolver.Resolver()
         if where:
-            resolver.nameservers = [where]
-        elif self.servers:
-            resolver.nameservers = self.servers
+            resolver = self._resolver_for(where)
+        else:
+            resolver = self._resolver
         return self._query(zone, what, resolver)
 
     def query(self, zone: str, what: str) -> Answer:
-        resolver = dns.resolver.Resolver()
-        if self.servers:
-            resolver.nameservers = self.servers
-        return self._query(zone, what, resolver)
+        if not self.servers or len(self.servers) < 2:
+            return self._query(zone, what, self._resolver)
+        # ask the configured servers at the same time instead of one after the other, first answer wins
+        queries = [self._pool.submit(self._query, zone, what, self._resolver_for(ns)) for ns in self.servers]
+        try:
+            failure = None
+            for query in as_completed(queries):
+                try:
+                    return query.result()
+                except (dns.resolver.NXDOMAIN, dns.resolver.YXDOMAIN, dns.resolver.NoAnswer):
+                    # a proper answer, just not a positive one
+                    raise
+                except dns.exception.DNSException as e:
+                    if failure is None:
+                        failure = e
+            raise failure
+        finally:
+            # servers not asked yet don't need to be
+            for query in queries:
+                query.cancel()
 
 
 class RecursiveResolver(BaseResolver):
-    def __init__(self) -> None:
+    def __init__(self, cache_path: Optional[str] = None) -> None:
         super().__init__()
-        self._query_cache = dict()
+        # bounded, locked and expires answers by their TTL
+        self._query_cache = dns.resolver.LRUCache(max_size=4096)
+        # optionally keep answers between runs, until their TTL runs out
+        # plain dbm with JSON entries, unlike shelve loading an entry can't run code from whoever wrote the file
+        self._disk_cache = dbm.open(cache_path, "c") if cache_path else None
+        self._disk_lock = threading.Lock()
+        # idle TCP connections per server, for answers that did not fit in a datagram
+        self._tcp_idle: Dict[str, List[socket.socket]] = dict()
+        self._tcp_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=QUERY_WORKERS)
+
+    def close(self) -> None:
+        # queries still running are losers of a race, let them time out before closing what they use
+        self._pool.shutdown(cancel_futures=True)
+        with self._disk_lock:
+            if self._disk_cache is not None:
+                self._disk_cache.close()
+                self._disk_cache = None
+        with self._tcp_lock:
+            for socks in self._tcp_idle.values():
+                for sock in socks:
+                    sock.close()
+            self._tcp_idle.clear()
+
+    def _disk_get(self, key: Tuple[str, str]) -> Optional[Answer]:
+        with self._disk_lock:
+            if self._disk_cache is None:
+                return None
+            entry = self._disk_cache.get(" ".join(key))
+        if entry is None:
+            return None
+        try:
+            entry = json.loads(entry)
+            expiration = float(entry["expiration"])
+            nameserver = str(entry["nameserver"])
+            if expiration <= time.time():
+                return None
+            response = dns.message.from_wire(base64.b64decode(entry["wire"]))
+        except (ValueError, TypeError, KeyError, dns.exception.DNSException):
+            # not something we wrote, treat as not cached
+            return None
+        q = response.question[0]
+        answer = Answer(q.name, q.rdtype, q.rdclass, response, nameserver, 53)
+        # TTLs in the stored response count from when it was received
+        answer.expiration = expiration
+        return answer
+
+    def _disk_put(self, key: Tuple[str, str], answer: Answer):
+        with self._disk_lock:
+            if self._disk_cache is None:
+                return
+            # written out when the cache is closed
+            self._disk_cache[" ".join(key)] = json.dumps(dict(
+                expiration=answer.expiration,
+                nameserver=answer.nameserver,
+                wire=base64.b64encode(answer.response.to_wire()).decode("ascii"),
+            ))
 
     def query(self, zone: str, what: str) -> Answer:
         key = (zone.upper(), what.upper())
-        if key not in self._query_cache:
-            nameservers = self._expand_root_servers()
-            self._query_cache[key] = self._recursive_query(nameservers, zone, what)
-        return self._query_cache[key]
+        answer = self._query_cache.get(key)
+        if answer is None:
+            answer = self._disk_get(key)
+            if answer is None:
+                nameservers = self._expand_root_servers()
+                answer = self._recursive_query(nameservers, zone, what)
+                self._disk_put(key, answer)
+            self._query_cache.put(key, answer)
+        return answer
 
     def query_at(self, zone: str, what: str, where: str) -> Answer:
-        query = dns.message.make_query(zone, what)
+        # EDNS0 lets most DNSKEY/RRSIG answers fit in a datagram, truncated ones are retried over TCP
+        query = dns.message.make_query(zone, what, use_edns=0, payload=1232)
         try:
-            res = dns.query.tcp(query, where)
-        except ConnectionError as ex:
-            raise dns.resolver.NoNameservers(request=query, errors=[(where, 1, 53, ex, None)])
+            try:
+                res = dns.query.udp(query, where, timeout=QUERY_TIMEOUT, raise_on_truncation=True)
+            except dns.message.Truncated:
+                res = self._query_tcp(query, where)
+        except (OSError, EOFError, dns.exception.Timeout) as ex:
+            raise dns.resolver.NoNameservers(request=query, errors=[(where, 0, 53, ex, None)])
 
         return Answer(
             dns.name.from_text(zone),
@@ -118,46 +317,74 @@ class RecursiveResolver(BaseResolver):
             53,
         )
 
-    def _expand_root_servers(self) -> Iterator[str]:
-        from .data.dns import ROOT_SERVERS
+    def _query_tcp(self, query: dns.message.Message, where: str) -> dns.message.Message:
+        # a server that truncated once will likely do so again for the other queries on the same zone,
+        # so keep its connection open instead of doing a new handshake each time
+        with self._tcp_lock:
+            idle = self._tcp_idle.get(where)
+            sock = idle.pop() if idle else None
+        if sock is not None:
+            try:
+                return self._tcp_exchange(query, where, sock)
+            except (OSError, EOFError, dns.exception.Timeout):
+                # the server closed the idle connection, start over
+                pass
+        sock = socket.create_connection((where, 53), timeout=QUERY_TIMEOUT)
+        sock.setblocking(False)
+        return self._tcp_exchange(query, where, sock)
+
+    def _tcp_exchange(self, query: dns.message.Message, where: str, sock: socket.socket) -> dns.message.Message:
+        try:
+            res = dns.query.tcp(query, where, timeout=QUERY_TIMEOUT, sock=sock)
+        except BaseException:
+            sock.close()
+            raise
+        with self._tcp_lock:
+            self._tcp_idle.setdefault(where, []).append(sock)
+        return res
+
+    def _expand_root_servers(self) -> Tuple[str, ...]:
         if self.prefer_v4:
-            yield from (v4 for h, v4, v6 in ROOT_SERVERS)
-            yield from (v6 for h, v4, v6 in ROOT_SERVERS)
-        else:
-            yield from (v6 for h, v4, v6 in ROOT_SERVERS)
-            yield from (v4 for h, v4, v6 in ROOT_SERVERS)
+            return _ROOTS_V4_FIRST
+        return _ROOTS_V6_FIRST
 
     @staticmethod
     def _addr_from_additional(adds: List[dns.rrset.RRset]):
         result = dict()
         for add in adds:
-            if add.name not in result:
-                result[add.name] = dict()
-            for k, v in add.items.items():
+            hints = result.setdefault(add.name, dict())
+            for k in add:
                 if k.rdtype == dns.rdatatype.A or k.rdtype == dns.rdatatype.AAAA:
-                    if k.rdtype in result[add.name]:
-                        result[add.name][k.rdtype].append(k.address)
-                    else:
-                        result[add.name][k.rdtype] = [k.address]
+                    hints.setdefault(k.rdtype, []).append(k.address)
         return result
 
     def _authority_ns_resolver(self, authority: List, additional: List) -> Iterator[str]:
         addrs = self._addr_from_additional(additional)
 
-        # avoid excessive A/AAAA lookups by only generating them if actually needed
+        nshosts = [nsrec.target for rrset in authority if rrset.rdtype == dns.rdatatype.NS for nsrec in rrset]
+        missing = [nshost for nshost in nshosts if nshost not in addrs]
+
+        # avoid excessive A/AAAA lookups by only generating them if actually needed, but once glue
+        # runs out, look up all remaining hosts at the same time instead of one after the other
         def proto_gen(rdata: int, rr: str):
-            for rrset in authority:
-                if rrset.rdtype == dns.rdatatype.NS:
-                    for nsrec in rrset:
-                        nshost = nsrec.target
-                        if nshost in addrs:
-                            hints = addrs[nshost]
-                            if rdata in hints:
-                                yield from hints[rdata]
-                        else:
-                            answer = self.query(nshost.to_text(), rr)
-                            for a in answer:
-                                yield a.address
+            lookups = None
+            try:
+                for nshost in nshosts:
+                    if nshost in addrs:
+                        hints = addrs[nshost]
+                        if rdata in hints:
+                            yield from hints[rdata]
+                    else:
+                        if lookups is None:
+                            lookups = {host: self._submit(self.query, host.to_text(), rr) for host in missing}
+                        answer = lookups[nshost].result()
+                        for a in answer:
+                            yield a.address
+            finally:
+                if lookups is not None:
+                    # the caller may stop early once a server answered
+                    for lookup in lookups.values():
+                        lookup.cancel()
 
         if self.prefer_v4:
             yield from proto_gen(dns.rdatatype.A, "A")
@@ -172,42 +399,76 @@ class RecursiveResolver(BaseResolver):
         na.nameserver = ns
         return na
 
+    def _submit(self, fn, *args) -> _Task:
+        task = _Task(fn, *args)
+        self._pool.submit(task.run)
+        return task
+
+    def _race(self, nameservers: Iterable[str], qname: str, what: str) -> Iterator[Tuple[str, Future]]:
+        # keep a few queries in flight and hand out responses in the order they arrive
+        nameservers = iter(nameservers)
+        pending: Dict[Future, Tuple[str, _Task]] = dict()
+        try:
+            while True:
+                for ns in itertools.islice(nameservers, RACE_WIDTH - len(pending)):
+                    task = self._submit(self.query_at, qname, what, ns)
+                    pending[task.future] = (ns, task)
+                if not pending:
+                    return
+                if not any(task.started for ns, task in pending.values()):
+                    # all workers are busy, possibly waiting on us
+                    next(iter(pending.values()))[1].run()
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    yield pending.pop(fut)[0], fut
+        finally:
+            # the caller stops once a server gave a usable answer, drop the queries not sent yet
+            for ns, task in pending.values():
+                task.cancel()
+            if hasattr(nameservers, "close"):
+                # also stops the glue lookups behind them
+                nameservers.close()
+
     def _recursive_query(self, nameservers: Iterable[str], qname: str, what: str) -> Answer:
         errors = []
-        for ns in nameservers:
-            try:
-                ans = self.query_at(qname, what, ns)
-            except dns.resolver.NoNameservers:
-                continue
-            except dns.exception.DNSException:
-                raise
-            except ConnectionError as ex:
-                errors.append((ns, 1, 53, ex, None))
-                continue
-            rcode = ans.response.rcode()
-            if rcode == dns.rcode.NOERROR:
-                # is this your final answer?
-                if ans.rrset:
-                    return ans
-
-                # actually, try somewhere else
-                for rrset in ans.response.answer:
-                    if rrset.rdtype == dns.rdatatype.CNAME:
-                        return self.query(rrset[0].target.to_text(), what)
-
-                # response tells us a better authority?
-                if ans.response.authority:
-                    if any(rrset.rdtype == dns.rdatatype.SOA for rrset in ans.response.authority):
-                        # we found the authority, but still got no answer
-                        raise self._make_NA(ans, ns)
-                    if not any(rrset.rdtype == dns.rdatatype.NS for rrset in ans.response.authority):
-                        # reached the end of recursion without proper error
-                        raise self._make_NA(ans, ns)
-                    nameservers = self._authority_ns_resolver(ans.response.authority, ans.response.additional)
-                    return self._recursive_query(nameservers, qname, what)
-            elif rcode == dns.rcode.NXDOMAIN:
-                raise dns.resolver.NXDOMAIN(qnames=[qname], responses={qname: ans.response})
-            elif rcode == dns.rcode.YXDOMAIN:
-                raise dns.resolver.YXDOMAIN()
+        # closed before going deeper, so the queries of this level don't hold up the next one
+        with contextlib.closing(self._race(nameservers, qname, what)) as race:
+            for ns, response in race:
+                try:
+                    ans = response.result()
+                except dns.resolver.NoNameservers:
+                    continue
+                except dns.exception.DNSException:
+                    raise
+                except ConnectionError as ex:
+                    errors.append((ns, 1, 53, ex, None))
+                    continue
+                rcode = ans.response.rcode()
+                if rcode == dns.rcode.NOERROR:
+                    # is this your final answer?
+                    if ans.rrset:
+                        return ans
+
+                    # actually, try somewhere else
+                    for rrset in ans.response.answer:
+                        if rrset.rdtype == dns.rdatatype.CNAME:
+                            race.close()
+                            return self.query(rrset[0].target.to_text(), what)
+
+                    # response tells us a better authority?
+                    if ans.response.authority:
+                        if any(rrset.rdtype == dns.rdatatype.SOA for rrset in ans.response.authority):
+                            # we found the authority, but still got no answer
+                            raise self._make_NA(ans, ns)
+                        if not any(rrset.rdtype == dns.rdatatype.NS for rrset in ans.response.authority):
+                            # reached the end of recursion without proper error
+                            raise self._make_NA(ans, ns)
+                        nameservers = self._authority_ns_resolver(ans.response.authority, ans.response.additional)
+                        race.close()
+                        return self._recursive_query(nameservers, qname, what)
+                elif rcode == dns.rcode.NXDOMAIN:
+                    raise dns.resolver.NXDOMAIN(qnames=[qname], responses={qname: ans.response})
+                elif rcode == dns.rcode.YXDOMAIN:
+                    raise dns.resolver.YXDOMAIN()
         query = dns.message.make_query(qname, what)
         raise dns.resolver.NoNameservers(request=query, errors=errors)
@@ -1,10 +1,14 @@
 #!/usr/bin/env -S python3 -u
 import argparse
+import dataclasses
+import functools
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from operator import attrgetter, methodcaller
 from pathlib import Path
-from pprint import pprint
-from typing import List
+from typing import List, Optional, Callable, Tuple
 
 import dns
 
@@ -17,6 +21,27 @@ from .resolver import StubResolver, RecursiveResolver
 from .util import groupby_freeze
 
 
+_EPOCH = datetime.fromtimestamp(0, timezone.utc)
+# rotation interval defaults, keep in sync with the help texts
+_ONE_WEEK = timedelta(weeks=1)
+_TWO_WEEKS = timedelta(weeks=2)
+# sort keys without a next change last, and those with broken timing first
+_FAR_FUTURE = datetime(3000, 1, 1, tzinfo=timezone.utc)
+_FAR_PAST = datetime(1000, 1, 1, tzinfo=timezone.utc)
+
+
+@dataclasses.dataclass(slots=True)
+class SetTimes:
+    key: KeyFile
+    times: dict
+
+
+@dataclasses.dataclass(slots=True)
+class MakeSuccessor:
+    template: KeyFile
+    activate_at: datetime
+
+
 class ResolverListAction(ListAppendAction):
     def filter(self, arg):
         if dns.inet.is_address(arg):
@@ -29,24 +54,24 @@ class ResolverListAction(ListAppendAction):
         return list(set(oldlist).union(newlist))
 
 
-def sort_by_field(field: str):
+def sort_by_field(field: str, when: Optional[datetime] = None):
     match field:
         case "ZONE":
-            return lambda k: k.zone
+            return attrgetter("zone")
         case "TYPE":
-            return lambda k: k.type
+            return attrgetter("type")
         case "ALG":
-            return lambda k: k.algo
+            return attrgetter("algo")
         case "ID":
-            return lambda k: k.keyid
+            return attrgetter("keyid")
         case "STATE":
-            return lambda k: k.state()
+            return methodcaller("state", when)
         case "DATE":
             def sorter(k):
                 try:
-                    return k.next_change() or datetime(3000, 1, 1, tzinfo=timezone.utc)
+                    return k.next_change(ref=when) or _FAR_FUTURE
                 except ValueError:
-                    return datetime(1000, 1, 1, tzinfo=timezone.utc)
+                    return _FAR_PAST
             return sorter
         case "HOST":
             return lambda k: tuple(reversed(k.zone.split(".")))
@@ -61,7 +86,39 @@ def fmt_next_change(ref: datetime, key: KeyFile) -> str:
         return str(e)
     if n is None:
         return "-"
-    return n.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M")
+    return _fmt_utc(n)
+
+
+# keys rotated on one schedule share their change dates
+@functools.lru_cache(maxsize=4096)
+def _fmt_utc(date: datetime) -> str:
+    if date.tzinfo is not timezone.utc:
+        date = date.astimezone(timezone.utc)
+    return date.strftime("%Y-%m-%d %H:%M")
+
+
+def _server_column(ns: str, dskeys: dict, dnskeys: dict, signers: dict) -> Callable[[Tuple[int, int]], str]:
+    if ns in dskeys:
+        # was this server queried for DS state at the resolver?
+        ds = dskeys[ns]
+        if isinstance(ds, Exception):
+            error = repr(ds)[:4]
+            return lambda ksig: error
+        ds = frozenset(ds)
+        return lambda ksig: "DS" if ksig in ds else ""
+    if ns in dnskeys and ns in signers:
+        # was this server queried for DNSKEY + RRSIG state at defined NS?
+        published, signing = dnskeys[ns], signers[ns]
+        if isinstance(published, Exception):
+            error = repr(published)[:4]
+            return lambda ksig: error
+        if isinstance(signing, Exception):
+            error = repr(signing)[:6]
+            return lambda ksig: error
+        published, signing = frozenset(published), frozenset(signing)
+        return lambda ksig: ("P" if ksig in published else " ") + " " + ("S" if ksig in signing else " ")
+    # no information in this column
+    return lambda ksig: ""
 
 
 def fmt_server_name(name: str):
@@ -74,14 +131,21 @@ def main_list(tool: DnsSec, args: argparse.Namespace) -> int:
         when = args.when
     else:
         when = nowutc()
-    if args.state:
-        keys = args.state.as_filter(keys, key=lambda k: k.state(when))
-    if args.type:
-        keys = args.type.as_filter(keys, key="type")
+    # needed for filtering and display, only compute once
+    states = {key: key.state(when) for key in keys}
+    # one pass over the keys for both filters, cheapest test first
+    type_ok = args.type.as_predicate(key="type") if args.type else None
+    state_ok = args.state.as_predicate(key=states.get) if args.state else None
+    if type_ok and state_ok:
+        keys = filter(lambda k: type_ok(k) and state_ok(k), keys)
+    elif type_ok or state_ok:
+        keys = filter(type_ok or state_ok, keys)
     if args.sort:
-        keys = args.sort.as_multi_sorter(keys, key=sort_by_field)
-    keys = list(keys)
-    zone_width = max(len(k.zone) for k in keys) if keys else 4
+        # sort by the same state that is shown
+        keys = args.sort.as_multi_sorter(keys, key=lambda field: states.get if field == "STATE" else sort_by_field(field, when))
+    if args.recurse or args.verify_ns:
+        # iterated more than once below, otherwise just stream into the table
+        keys = list(keys)
 
     match args.output:
         case "JSON":
@@ -93,7 +157,7 @@ def main_list(tool: DnsSec, args: argparse.Namespace) -> int:
             raise ValueError("Invalid output format")
     printer.start_header()
     if args.recurse:
-        printer.add("Zone", w=zone_width)
+        printer.add("Zone", w=max(map(len, (k.zone for k in keys)), default=4))
     else:
         print("Zone: ", args.ZONE)
     if args.permissions:
@@ -113,7 +177,7 @@ def main_list(tool: DnsSec, args: argparse.Namespace) -> int:
         printer.add("Next Key Event", w=16)
     if args.verify_ns:
         if args.resolver == "RECURSE":
-            res = RecursiveResolver()
+            res = RecursiveResolver(cache_path=args.cache)
         else:
             res = StubResolver(args.resolver)
         res.prefer_v4 = args.ip == 4
@@ -122,14 +186,28 @@ def main_list(tool: DnsSec, args: argparse.Namespace) -> int:
         if servers:
             key_collection.set_explicit_nameservers(servers)
         zones = {k.zone for k in keys}
-        print("Collecting state of zone: ", end="")
-        for zone in zones:
-            print(zone, end=" ", flush=True)
-            key_collection.query_zone(zone)
+        print("Collecting state of zone: ", end="", flush=True)
+        # zones are independent, wait for all of them at once
+        queries = []
+        # closing the resolver also writes out its cache, even if collecting is interrupted
+        with res, ThreadPoolExecutor(max_workers=min(8, len(zones) or 1)) as ex:
+            for zone in zones:
+                query = ex.submit(key_collection.query_zone, zone)
+                query.add_done_callback(lambda _, zone=zone: print(zone, end=" ", flush=True))
+                queries.append(query)
+        for query in queries:
+            # re-raise any failure
+            query.result()
         print("")
-        print("Responses from nameservers: ", " ".join(key_collection.contacted_servers()))
+        zonens = key_collection.contacted_servers()
+        # every row fills every server column, so sort out per zone what each column can tell
+        columns = {zone: [_server_column(ns,
+                                         key_collection.zone_ds[zone],
+                                         key_collection.zone_dnskey[zone],
+                                         key_collection.zone_signers[zone]) for ns in zonens] for zone in zones}
+        print("Responses from nameservers: ", " ".join(zonens))
         print("")
-        for ns in key_collection.contacted_servers():
+        for ns in zonens:
             printer.add(fmt_server_name(ns) if ns is not None else "?")
     printer.done()
 
@@ -142,7 +220,7 @@ def main_list(tool: DnsSec, args: argparse.Namespace) -> int:
         printer.add(key.type)
         printer.add(key.algo * (-1 if key.is_supported() is False else 1))
         printer.add(key.keyid)
-        printer.add(key.state(when))
+        printer.add(states[key])
         if args.calendar:
             printer.add(fmt_datetime_relative(when, key.d_create))
             printer.add(fmt_datetime_relative(when, key.d_publish))
@@ -152,34 +230,10 @@ def main_list(tool: DnsSec, args: argparse.Namespace) -> int:
         else:
             printer.add(fmt_next_change(when, key))
         if args.verify_ns:
-            zonens = key_collection.contacted_servers()
             ksig = key.signer_id()
-            dskeys = key_collection.zone_ds[key.zone]
-            dnskeys = key_collection.zone_dnskey[key.zone]
-            signers = key_collection.zone_signers[key.zone]
             # fill the table columns
-            for ns in zonens:
-                if ns in dskeys:
-                    # was this server queried for DS state at the resolver?
-                    if isinstance(dskeys[ns], Exception):
-                        active_ds = repr(dskeys[ns])[:4]
-                    else:
-                        active_ds = "DS" if ksig in dskeys[ns] else ""
-                    printer.add(active_ds)
-                elif ns in dnskeys and ns in signers:
-                    # was this server queried for DNSKEY + RRSIG state at defined NS?
-                    flags = []
-                    if isinstance(dnskeys[ns], Exception):
-                        flags.append(repr(dnskeys[ns])[:4])
-                    elif isinstance(signers[ns], Exception):
-                        flags.append(repr(signers[ns])[:6])
-                    else:
-                        flags.append("P" if ksig in dnskeys[ns] else " ")
-                        flags.append("S" if ksig in signers[ns] else " ")
-                    printer.add(" ".join(flags))
-                else:
-                    # no information in this column
-                    printer.add("")
+            for column in columns[key.zone]:
+                printer.add(column(ksig))
         printer.done()
         if args.print_record:
             align = printer.column_start("Algo")
@@ -205,10 +259,13 @@ def main_archive(tool: DnsSec, args: argparse.Namespace) -> int:
             expired.append(key)
     print(f"Found {len(expired)} expired keys, {exp_ksk} of which are key-signing keys.")
     plan = []
+    year_dirs = dict()
     for key in expired:
         if args.auto:
-            year = str(key.d_inactive.year).rjust(4, "0")
-            tdir = tool.path / (args.TARGET + year)
+            year = key.d_inactive.year
+            tdir = year_dirs.get(year)
+            if tdir is None:
+                tdir = year_dirs[year] = tool.path / f"{args.TARGET}{year:04d}"
         else:
             tdir = tool.path / args.TARGET
         plan.append([key.type, key.path_rr, tdir])
@@ -217,14 +274,17 @@ def main_archive(tool: DnsSec, args: argparse.Namespace) -> int:
         return 0
     if args.dry_run:
         print("Would move: ")
+    else:
+        # keys archived together mostly share a few target directories
+        for tdir in dict.fromkeys(dst for typ, src, dst in plan):
+            tdir.mkdir(parents=True, exist_ok=True)
     src: Path
     dst: Path
     for typ, src, dst in plan:
         if args.dry_run:
             print("  ", typ, " ", src, " -> ", dst)
         else:
-            dst.mkdir(parents=True, exist_ok=True)
-            src.rename(dst / src.name)
+            os.replace(src, os.path.join(dst, src.name))
     return 0
 
 
@@ -233,9 +293,10 @@ def main_rotate(tool: DnsSec, args: argparse.Namespace) -> int:
         raise NotImplementedError("Only ZSKs can be rotated.")
     keys = tool.list_keys(args.ZONE, recursive=False)
     # ignore keys that are already expired and deleted or don't have a runtime
-    keys = filter(lambda k: k.type == args.type, keys)
-    keys = filter(lambda k: k.d_inactive is not None and k.state() != "DEL", keys)
-    keys = list(keys)
+    keys = [k for k in keys if k.type == args.type and k.d_inactive is not None]
+    # current state of each key, used for selection and grouping below
+    states = {k: k.state() for k in keys}
+    keys = [k for k in keys if states[k] != "DEL"]
     if len(keys) == 0:
         print("No keys qualified for renewal.")
         return 0
@@ -265,13 +326,15 @@ def main_rotate(tool: DnsSec, args: argparse.Namespace) -> int:
         print(f"Zone: {args.ZONE}, signature algo: {algo}")
         # when new keys are made, always use the most recently generated one as a template
         # this allows the user to "inject" new key configs by hot-swapping a key between rotations
-        template = sorted(akeys, key=lambda k: k.d_create or datetime.fromtimestamp(0))[-1]
+        template = max(reversed(akeys), key=lambda k: k.d_create or _EPOCH)
 
-        by_state = groupby_freeze(akeys, lambda k: k.state())
+        by_state = groupby_freeze(akeys, states.get)
         if "ACT" not in by_state:
             print(f"No keys are currently active for algorithm {algo}, please fix and rerun...", file=sys.stderr)
             continue
         activekeys = sorted(by_state["ACT"], key=lambda k: k.d_inactive)
+        # checked once per active key below, so only look at the dates once
+        windows = [w for w in map(KeyFile.active_window, akeys) if w is not None]
 
         # when a currently active key becomes inactive, there must be a key that becomes/is already
         # (depending on overlap). this is recursively true for any key currently active, not just the "main" / earliest
@@ -281,11 +344,10 @@ def main_rotate(tool: DnsSec, args: argparse.Namespace) -> int:
             ends = active.d_inactive + second
             # check if we need to fix the deletion time
             if active.d_delete is None or active.d_delete > ends + post_intv:
-                plan.append(["set_times", active, dict(delete=active.d_inactive + post_intv)])
-            successors = [k for k in akeys if k.state(ends) == "ACT"]
-            if not successors:
+                plan.append(SetTimes(active, dict(delete=active.d_inactive + post_intv)))
+            if not any(start <= ends and (end is None or ends < end) for start, end in windows):
                 # need to make one!
-                plan.append(["make_successor", template, active.d_inactive])
+                plan.append(MakeSuccessor(template, active.d_inactive))
         # any other key state is just transitional or set on key creation, so we're done here
 
     if not plan:
@@ -293,12 +355,14 @@ def main_rotate(tool: DnsSec, args: argparse.Namespace) -> int:
         return 0
 
     if args.dry_run:
+        # only needed here, keep it off the startup path
+        from pprint import pprint
         pprint(plan)
         return 0
 
-    def set_times(key: KeyFile, times):
+    def set_times(changes):
         try:
-            tool.key_settime(key, **times)
+            tool.key_settime_many(changes)
             return 0
         except BaseException as e:
             print(str(e), file=sys.stderr)
@@ -317,9 +381,21 @@ def main_rotate(tool: DnsSec, args: argparse.Namespace) -> int:
             print(str(e), file=sys.stderr)
             return 2
 
-    for task, *args in plan:
-        fn = locals()[task]
-        ret = fn(*args)
+    changes = []
+    successors = []
+    for step in plan:
+        match step:
+            case SetTimes(key, times):
+                changes.append((key, times))
+            case MakeSuccessor(template, activate_at):
+                successors.append((template, activate_at))
+    # timing changes of existing keys are independent of each other, run them as one batch
+    ret = set_times(changes)
+    if ret != 0:
+        return ret
+    # successors of one algorithm share the template key, so create them one after another
+    for template, activate_at in successors:
+        ret = make_successor(template, activate_at)
         if ret != 0:
             return ret
     return 0
@@ -394,6 +470,9 @@ def main():
     p_list.add_argument("--resolver", type=str, metavar="ADDR", action=ResolverListAction,
                         help="Resolver(s) to use instead of system default, or the special keyword 'recurse' to switch"
                              " to an internal recursive resolver. Can be combined and given multiple times, unless 'recurse' is used.")
+    p_list.add_argument("--cache", type=str, metavar="FILE",
+                        help="Keep answers of the internal recursive resolver in FILE between runs, as long as their TTL allows."
+                             " Requires --resolver recurse.")
     pg_ip = p_list.add_mutually_exclusive_group()
     pg_ip.add_argument("-4", dest="ip", action="store_const", const=4)
     pg_ip.add_argument("-6", dest="ip", action="store_const", const=6, default=6,
@@ -422,16 +501,16 @@ def main():
                           help="Filter keys by type")
     p_rotate.add_argument("-n", "--dry-run", action="store_true", default=False,
                           help="Don't perform action, just show plan")
-    p_rotate.add_argument("-b", "--prepublish", default=parse_datetime_relative("1w"), type=parse_datetime_relative,
+    p_rotate.add_argument("-b", "--prepublish", default=_ONE_WEEK, type=parse_datetime_relative,
                           metavar="INTERVAL",
                           help="Time to publish keys before its activation date (Default: 1w)")
-    p_rotate.add_argument("-l", "--lifetime", default=parse_datetime_relative("2w"), type=parse_datetime_relative,
+    p_rotate.add_argument("-l", "--lifetime", default=_TWO_WEEKS, type=parse_datetime_relative,
                           metavar="INTERVAL",
                           help="Active lifetime of keys (Default: 2w)")
-    p_rotate.add_argument("-o", "--overlap", default=parse_datetime_relative("1w"), type=parse_datetime_relative,
+    p_rotate.add_argument("-o", "--overlap", default=_ONE_WEEK, type=parse_datetime_relative,
                           metavar="INTERVAL",
                           help="Overlap between active keys, calculated from the end of active phase (Default: 1w)")
-    p_rotate.add_argument("-a", "--postpublish", default=parse_datetime_relative("1w"), type=parse_datetime_relative,
+    p_rotate.add_argument("-a", "--postpublish", default=_ONE_WEEK, type=parse_datetime_relative,
                           metavar="INTERVAL",
                           help="Time to publish keys after their deactivation date (Default: 1w)")
     p_rotate.set_defaults(func=main_rotate)
@@ -459,6 +538,8 @@ def main():
             if has_rec != len(args.resolver):
                 parser.error(f"Internal recursive resolver can not be combined with external resolvers")
             args.resolver = "RECURSE"
+    if "cache" in args and args.cache and args.resolver != "RECURSE":
+        parser.error("--cache can only be used with --resolver recurse")
 
     if "ZONE" in args and args.ZONE:
         if not args.ZONE.endswith("."):
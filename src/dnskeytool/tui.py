@@ -1,8 +1,8 @@
 import argparse
 import dataclasses
-import json
+import sys
 from operator import attrgetter
-from typing import List, Any, Optional, Union, Callable
+from typing import List, Dict, Any, Optional, Union, Callable, Tuple, FrozenSet
 
 
 class ParagraphFormatter(argparse.HelpFormatter):
@@ -16,8 +16,9 @@ class ParagraphFormatter(argparse.HelpFormatter):
 class ListAppendAction(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
         oldlist = getattr(namespace, self.dest) or []
-        newlist = [self.filter(value.strip()) for value in values.split(",")]
-        setattr(namespace, self.dest, self.combine(oldlist, [arg for arg in newlist if arg is not None]))
+        filt = self.filter
+        newlist = [arg for arg in (filt(value.strip()) for value in values.split(",")) if arg is not None]
+        setattr(namespace, self.dest, self.combine(oldlist, newlist))
 
     def filter(self, arg):
         return arg
@@ -32,7 +33,8 @@ class EnumAction(argparse.Action):
         if not choices:
             choices = []
         if not case_sensitive:
-            choices = [str(c).upper() for c in choices]
+            # interned, so parsed values end up as the same objects as matching string constants elsewhere
+            choices = [sys.intern(str(c).upper()) for c in choices]
         super().__init__(
             option_strings=option_strings,
             dest=dest,
@@ -45,6 +47,16 @@ class EnumAction(argparse.Action):
         self.values = choices
         self.case_sensitive = case_sensitive
         self.allow_abbrev = allow_abbrev
+        # every prefix of a choice, mapped to all choices it could stand for
+        self.prefixes: Dict[str, List[str]] = dict()
+        for c in self.values:
+            for i in range(1, len(c) + 1):
+                self.prefixes.setdefault(c[:i], []).append(c)
+        # every accepted input mapped to the stored choice, so valid input only needs one lookup
+        self.accepted: Dict[str, str] = dict()
+        if allow_abbrev:
+            self.accepted.update((prefix, matching[0]) for prefix, matching in self.prefixes.items() if len(matching) == 1)
+        self.accepted.update((c, c) for c in self.values)
         if not metavar:
             self.metavar = self.choices_str()
         else:
@@ -81,16 +93,16 @@ class EnumAction(argparse.Action):
     def matched_value(self, s: str):
         if not self.case_sensitive:
             s = s.upper()
-        # simple cases: not given or direct match?
-        if s == "" or s in self.values:
+        # simple cases: not given, direct match or unique abbreviation?
+        if s == "":
             return s
+        if s in self.accepted:
+            return self.accepted[s]
+        # only errors are left, find out which one
         if self.allow_abbrev:
-            # uniquely specified?
-            matching = [c for c in self.values if c.startswith(s)]
+            matching = self.prefixes.get(s)
             if not matching:
                 raise ValueError(f"Unknown value {s}")
-            if len(matching) == 1:
-                return matching[0]
             raise ValueError(f"Ambiguous argument {s}, could mean one of {' '.join(matching)}")
         raise ValueError(f"Invalid argument {s}")
 
@@ -102,12 +114,12 @@ class EnumAction(argparse.Action):
         return parsed[0]
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True, frozen=True)
 class MultipleEnumType:
-    values: List[str]
-    suffix: List[bool]
+    values: Tuple[str, ...]
+    suffix: Tuple[bool, ...]
 
-    def as_sets(self):
+    def as_sets(self) -> Tuple[FrozenSet[str], FrozenSet[str]]:
         pos = set()
         neg = set()
         for v, s in zip(self.values, self.suffix):
@@ -115,29 +127,49 @@ class MultipleEnumType:
                 neg.add(v)
             else:
                 pos.add(v)
-        return pos, neg
+        return frozenset(pos), frozenset(neg)
 
-    def as_filter(self, iterable, key=Union[Callable, str]):
+    def as_predicate(self, key: Union[Callable, str]) -> Callable[[Any], bool]:
         if isinstance(key, str):
             key = attrgetter(key)
         pos, neg = self.as_sets()
+        # decide once which test applies instead of for every item
+        if not neg:
+            return lambda x: key(x) in pos
+        if not pos:
+            return lambda x: key(x) not in neg
 
         def comparator(x):
             k = key(x)
-            if k in pos:
-                return True
-            if neg:
-                return k not in neg
-            return False
-        return filter(comparator, iterable)
+            return k in pos or k not in neg
+        return comparator
+
+    def as_filter(self, iterable, key: Union[Callable, str]):
+        return filter(self.as_predicate(key), iterable)
 
     def as_multi_sorter(self, iterable, key=None):
         if key is None:
             key = attrgetter
-        for fieldname, desc in reversed(list(zip(self.values, self.suffix))):
-            keyfun = key(fieldname)
-            iterable = sorted(iterable, key=keyfun, reverse=desc)
-        return iterable
+        keyfuns = [key(fieldname) for fieldname in self.values]
+        if len(set(self.suffix)) == 1:
+            # all in the same direction: plain tuples, let sorted() reverse
+            return sorted(iterable, key=lambda x: tuple(f(x) for f in keyfuns), reverse=self.suffix[0])
+        # mixed directions: still one pass, descending fields compare inverted
+        fields = list(zip(keyfuns, self.suffix))
+        return sorted(iterable, key=lambda x: tuple(_Descending(f(x)) if desc else f(x) for f, desc in fields))
+
+
+class _Descending:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
 
 
 class MultipleEnumAction(EnumAction):
@@ -174,62 +206,112 @@ class MultipleEnumAction(EnumAction):
 
 class TablePrinterBase:
     def __init__(self) -> None:
-        self.column_meta: List[dict] = []
+        # one entry per column in each list
+        self.headers: List[str] = []
+        self.widths: List[int] = []
+        self.aligns: List[str] = []
+        # default format field of each column and the whole row template, built when the first row starts
+        self.cell_fields: Optional[List[str]] = None
+        self.row_template = ""
+        # offset of each column in a line, built on first use
+        self.starts: Optional[Dict[str, int]] = None
         self.state = "empty"
         self.current_row: List[str] = []
+        self.add = self.add_invalid
 
     def get_formatted(self, val: str, fmt: str, align: str, width: int):
         return format(val, align + str(width) + fmt)
 
     def column_start(self, name: str) -> int:
-        res = 0
-        for meta in self.column_meta:
-            if meta.get("name") == name:
-                return res
-            res += meta.get("width") + 1
-        return 0
+        # asked for on every row, but the header doesn't change once rows come in
+        if self.starts is None:
+            self.starts = dict()
+            res = 0
+            for header, width in zip(self.headers, self.widths):
+                self.starts.setdefault(header, res)
+                res += width + 1
+        return self.starts.get(name, 0)
+
+    @staticmethod
+    def write_line(line: str, flush=False):
+        # a single write per line, print() writes every item and separator on its own
+        sys.stdout.write(line + "\n")
+        if flush:
+            sys.stdout.flush()
+
+    def row_separator(self) -> str:
+        return " "
+
+    def format_row(self) -> str:
+        # body cells are stored unpadded, pad them all in one go
+        if len(self.current_row) == len(self.cell_fields):
+            return self.row_template.format(*self.current_row)
+        if len(self.current_row) > len(self.cell_fields):
+            raise ValueError(f"Row has {len(self.current_row)} cells, but the header only {len(self.cell_fields)}")
+        return self.row_separator().join(self.cell_fields[:len(self.current_row)]).format(*self.current_row)
 
     def emit_row(self):
-        print(*self.current_row, flush=True)
+        if self.state == "head":
+            # show the header right away, body rows are left to the stdout buffer until done()
+            self.write_line(" ".join(self.current_row), flush=True)
+        else:
+            self.write_line(self.format_row())
 
     def start_header(self):
         if self.state != "empty":
             raise ValueError("Can not start header at this point")
         self.current_row = []
         self.state = "head"
+        self.add = self.add_head
 
     def start_row(self):
         if self.state not in ["head", "row"]:
             raise ValueError("Can not start row at this point")
+        if self.cell_fields is None:
+            self.cell_fields = ["{:" + align + str(width) + "s}" for align, width in zip(self.aligns, self.widths)]
+            self.row_template = self.row_separator().join(self.cell_fields)
         self.current_row = []
         self.state = "row"
+        self.add = self.add_row
 
     def done(self):
         if self.current_row:
             self.emit_row()
         else:
             self.state = "done"
+            self.add = self.add_invalid
+            sys.stdout.flush()
         self.current_row = []
 
-    def add(self, val: Any, *,
-                  f="s", align="", w: Optional[int] = None):
+    # add() is bound to one of these by the state changes above, so cells don't have to check the state
+
+    def add_head(self, val: Any, *,
+                 f="s", align="", w: Optional[int] = None):
         if not isinstance(val, str):
             val = str(val)
-        match self.state:
-            case "head":
-                if w is None:
-                    w = len(val)
-                head = self.get_formatted(val, f, align, w)
-                self.current_row.append(head)
-                self.column_meta.append({"width": len(head), "align": align, "name": val})
-            case "row":
-                coli = len(self.current_row)
-                w = self.column_meta[coli].get("width", 0)
-                if not align:
-                    align = self.column_meta[coli].get("align", align)
-                self.current_row.append(self.get_formatted(val, f, align, w))
-            case _:
-                raise ValueError("Invalid state")
+        if w is None:
+            w = len(val)
+        head = self.get_formatted(val, f, align, w)
+        self.current_row.append(head)
+        self.headers.append(sys.intern(val))
+        self.starts = None
+        self.widths.append(len(head))
+        self.aligns.append(align)
+
+    def add_row(self, val: Any, *,
+                f="s", align="", w: Optional[int] = None):
+        if not isinstance(val, str):
+            val = str(val)
+        if f == "s" and not align:
+            # common case: column defaults, padded by the row template
+            self.current_row.append(val)
+            return
+        # already at column width, so the row template leaves it as is
+        coli = len(self.current_row)
+        self.current_row.append(self.get_formatted(val, f, align or self.aligns[coli], self.widths[coli]))
+
+    def add_invalid(self, val: Any, **kwargs):
+        raise ValueError("Invalid state")
 
 
 class TablePrinter(TablePrinterBase):
@@ -237,14 +319,14 @@ class TablePrinter(TablePrinterBase):
         super().__init__()
         self.with_grid = True
 
+    def row_separator(self) -> str:
+        return "|" if self.with_grid else " "
+
     def emit_row(self):
-        if self.with_grid:
-            print(*self.current_row, sep="|")
-            if self.state == "head":
-                delim = []
-                for meta in self.column_meta:
-                    delim.append("-" * meta.get("width", 1))
-                print("+".join(delim), flush=True)
+        if self.with_grid and self.state == "head":
+            line = "|".join(self.current_row)
+            line += "\n" + "+".join("-" * width for width in self.widths)
+            self.write_line(line, flush=True)
         else:
             super().emit_row()
 
@@ -253,28 +335,38 @@ class JSONPrinter(TablePrinterBase):
     def __init__(self) -> None:
         super().__init__()
         self.obj = []
+        self.names: Optional[Tuple[str, ...]] = None
 
     def column_start(self, name: str) -> int:
         return 0
 
+    def object_names(self) -> Tuple[str, ...]:
+        # the header is fixed by the time rows come in, so make duplicate names unique only once
+        if self.names is None:
+            names = dict()
+            # next suffix to try for each repeated name, so later repeats don't probe from _0 again
+            next_suffix: Dict[str, int] = dict()
+            for nam in self.headers:
+                if nam in names:
+                    i = next_suffix.get(nam, 0)
+                    while f"{nam}_{i}" in names:
+                        i += 1
+                    next_suffix[nam] = i + 1
+                    nam = f"{nam}_{i}"
+                names[nam] = None
+            self.names = tuple(names)
+        return self.names
+
     def emit_row(self):
         if self.state == "row":
-            obj = dict()
-            for val, meta in zip(self.current_row, self.column_meta):
-                nam = meta["name"]
-                if nam in obj:
-                    for i in range(100):
-                        if f"{nam}_{i}" not in obj:
-                            nam = f"{nam}_{i}"
-                            break
-                obj[nam] = val
-            self.obj.append(obj)
+            self.obj.append(dict(zip(self.object_names(), self.current_row)))
 
     def done(self):
         super().done()
         match self.state:
             case "head":
-                for meta in self.column_meta:
-                    meta["width"] = 0
+                self.widths = [0] * len(self.widths)
             case "done":
+                # only needed for this output format, keep it off the startup path
+                import json
                 print(json.dumps(self.obj, indent=2))
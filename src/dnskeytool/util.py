@@ -1,4 +1,4 @@
-import itertools
+from collections import defaultdict
 from typing import TypeVar, Iterable, Callable, Dict, List, Tuple
 
 T1 = TypeVar("T1")
@@ -6,15 +6,22 @@ T2 = TypeVar("T2")
 
 
 def groupby_freeze(iterable: Iterable[T1], key: Callable[[T1], T2]) -> Dict[T2, List[T1]]:
-    return {k: list(g) for k, g in itertools.groupby(iterable, key)}
+    # unlike itertools.groupby, this does not need the input to be ordered by key
+    groups = defaultdict(list)
+    for o in iterable:
+        groups[key(o)].append(o)
+    return dict(groups)
 
 
 def partition(test: Callable[[T1], bool], iterable: Iterable[T1]) -> Tuple[List[T1], List[T1]]:
     a = []
     b = []
+    # bind the appends once instead of looking them up for every item
+    a_append = a.append
+    b_append = b.append
     for o in iterable:
         if test(o):
-            a.append(o)
+            a_append(o)
         else:
-            b.append(o)
+            b_append(o)
     return a, b